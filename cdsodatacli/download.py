@@ -1,42 +1,223 @@
-import subprocess
-import requests
 import logging
 from tqdm import tqdm
 import datetime
 import time
 import os
+import errno
+import shutil
 import random
 import pandas as pd
-import geopandas as gpd
 from requests.exceptions import ChunkedEncodingError
+from urllib3.exceptions import ProtocolError
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-import shutil  # [修改点 1] 引入 shutil 用于跨平台文件移动
 import traceback
+import queue
+import threading
 
 from cdsodatacli.fetch_access_token import (
     get_bearer_access_token,
     remove_semaphore_token_file,
     MAX_VALIDITY_ACCESS_TOKEN,
     get_list_of_exising_token,
+    parse_token_date,
 )
 from cdsodatacli.session import (
     remove_semaphore_session_file,
+    list_active_session_files,
+    extra_session_safename,
     get_sessions_download_available,
+    get_session,
     MAX_SESSION_PER_ACCOUNT,
 )
-from cdsodatacli.query import fetch_data
 from cdsodatacli.utils import (
     get_conf,
     check_safe_in_archive,
     check_safe_in_spool,
-    check_safe_in_outputdir,
+    check_safes_in_archive,
+    check_safes_in_spool,
+    check_safes_in_outputdir,
+    verify_safes_in_outputdir,
+    dir_prefix,
 )
-from cdsodatacli.product_parser import ExplodeSAFE
 from collections import defaultdict
 
 # chunksize = 4096
-chunksize = 8192  # like in the CDSE example
+# chunksize = 8192  # like in the CDSE example
+chunksize = 1024 * 1024  # one reusable 1 Mo buffer per download
+NB_WRITE_BUFFERS = 4  # buffers in flight between network reads and disk writes
+BLACKLIST_DURATION = 60  # sec, first blacklisting of an account with too many errors
+MAX_BLACKLIST_DURATION = 3600  # sec, upper bound of the doubled blacklist duration
+RANGE_DOWNLOAD_MIN_SIZE = 512 * 1024 * 1024  # bytes, smaller products use one stream
+
+
+def fast_move(src, dst):
+    """
+    Move a file with a single rename, or with a kernel-side copy
+    (os.copy_file_range) when src and dst are on different filesystems.
+
+    Parameters
+    ----------
+    src (str): full path of the file to move
+    dst (str): full path of the destination
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                if not hasattr(os, "copy_file_range"):
+                    raise OSError(errno.ENOSYS, "copy_file_range not available")
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+                    pass
+            except OSError:
+                # no kernel-side copy between these filesystems: userspace copy
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, chunksize)
+        os.unlink(src)
+
+
+def preallocate(fd, size):
+    """
+    Reserve the disk space of a file up front (single extent, fails fast if the disk is full).
+    No-op where os.posix_fallocate is missing (macOS, Windows) or not supported by the filesystem.
+
+    Parameters
+    ----------
+    fd (int): file descriptor
+    size (int): number of bytes
+    """
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+
+
+def iter_raw_stream(response):
+    """
+    Read the raw body of a streamed response into a single reusable buffer.
+
+    Parameters
+    ----------
+    response (requests.Response): response of a request sent with stream=True
+
+    Returns
+    -------
+        data (generator of memoryview): successive slices of the buffer (only valid until the next one)
+    """
+    # read the raw stream into a single preallocated buffer
+    # instead of allocating a new bytes object per chunk
+    # the zip is served as is: urllib3 decoders are only used if the server
+    # compressed the transfer
+    response.raw.decode_content = (
+        response.headers.get("Content-Encoding", "identity") != "identity"
+    )
+    buf = bytearray(chunksize)
+    mv = memoryview(buf)
+    while True:
+        nread = response.raw.readinto(mv)
+        if not nread:
+            break
+        yield mv[:nread]
+
+
+def stream_to_file(response, f):
+    """
+    Copy the raw body of a streamed response to a file. The disk writes are
+    done by a dedicated thread from a small ring of buffers, so that they
+    overlap with the network reads instead of alternating with them.
+
+    Parameters
+    ----------
+    response (requests.Response): response of a request sent with stream=True
+    f (file object): output file opened in binary write mode
+    """
+    response.raw.decode_content = (
+        response.headers.get("Content-Encoding", "identity") != "identity"
+    )
+    free_buffers = queue.Queue()
+    for _ in range(NB_WRITE_BUFFERS):
+        free_buffers.put(bytearray(chunksize))
+    filled_buffers = queue.Queue()
+    write_errors = []
+
+    def writer():
+        while True:
+            item = filled_buffers.get()
+            if item is None:
+                break
+            buf, nread = item
+            if not write_errors:
+                try:
+                    f.write(memoryview(buf)[:nread])
+                except Exception as e:
+                    write_errors.append(e)
+            free_buffers.put(buf)
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    try:
+        while not write_errors:
+            buf = free_buffers.get()
+            nread = response.raw.readinto(buf)
+            if not nread:
+                break
+            filled_buffers.put((buf, nread))
+    finally:
+        filled_buffers.put(None)
+        writer_thread.join()
+    if write_errors:
+        raise write_errors[0]
+
+
+def download_ranges(session, headers, url, fd, total_length_bytes, nb_connections):
+    """
+    Download a product with parallel HTTP Range requests, each one writing its
+    own slice of the (already sized) output file with os.pwrite.
+
+    Parameters
+    ----------
+    session (request Obj)
+    headers (dict)
+    url (str)
+    fd (int): file descriptor of the output file
+    total_length_bytes (int): size of the product
+    nb_connections (int): number of parallel Range requests
+
+    Returns
+    -------
+        ranges_served (bool): False -> the server ignored the Range header (200 instead of 206)
+    """
+    step = -(-total_length_bytes // nb_connections)
+
+    def fetch_range(start):
+        end = min(start + step, total_length_bytes) - 1
+        range_headers = dict(headers)
+        range_headers["Range"] = "bytes=%s-%s" % (start, end)
+        with session.get(
+            url, headers=range_headers, stream=True, timeout=(30, 600)
+        ) as response:
+            if response.status_code != 206:
+                logging.debug("Range not served: %s", response.status_code)
+                return False
+            offset = start
+            for data in iter_raw_stream(response):
+                offset += os.pwrite(fd, data, offset)
+        if offset != end + 1:
+            raise ProtocolError("incomplete range %s-%s" % (start, end))
+        return True
+
+    with ThreadPoolExecutor(max_workers=nb_connections) as executor:
+        ranges_served = all(
+            executor.map(fetch_range, range(0, total_length_bytes, step))
+        )
+    return ranges_served
 
 
 def CDS_Odata_download_one_product_v2(
@@ -46,17 +227,19 @@ def CDS_Odata_download_one_product_v2(
     output_filepath,
     semaphore_token_file,
     cdsodatacli_conf_file=None,
+    nb_connections=1,
 ):
     """
      v2 is without tqdm
     Parameters
     ----------
-    session (request Obj)
-    headers (dict)
+    session (request Obj): session shared by all the downloads of a CDSE login (see session.get_session)
+    headers (dict): headers of the request, holding the access token
     url (str)
     output_filepath (str): full path where to store fetch file
     semaphore_token_file (str): full path of the file storing an active access token
-    cdsodatacli_conf_file (str): path to the cdsodatacli configuration file
+    cdsodatacli_conf_file (str): path to the cdsodatacli configuration file (kept for compatibility, not used)
+    nb_connections (int): number of parallel Range requests for products larger than RANGE_DOWNLOAD_MIN_SIZE, each one is a CDSE session of the account: the caller must hold as many session slots [default=1 -> single stream]
 
     Returns
     -------
@@ -67,49 +250,81 @@ def CDS_Odata_download_one_product_v2(
     status_meaning = "unknown_code"
     t0 = time.time()
     
-    conf = get_conf(path_config_file=cdsodatacli_conf_file)
-    output_filepath_tmp = os.path.join(
-        conf["pre_spool"], os.path.basename(output_filepath) + ".tmp"
-    )
+    # the tmp file lives next to the final file so that the final move is a
+    # single rename on the same filesystem (no copy+unlink across mounts)
+    output_filepath_tmp = output_filepath + ".tmp"
     safename_base = os.path.basename(output_filepath).replace(".zip", "")
-    
-    # 确保 pre_spool 存在
-    if not os.path.exists(conf["pre_spool"]):
-        os.makedirs(conf["pre_spool"], exist_ok=True)
 
+    nb_connections = min(nb_connections, MAX_SESSION_PER_ACCOUNT)
     status = 0
     try:
         with open(output_filepath_tmp, "wb") as f:
             logging.debug("Downloading %s" % output_filepath)
-            # [修改点 2] 添加 timeout 防止挂起 (连接超时30s, 读取超时600s)
-            response = session.get(url, headers=headers, stream=True, timeout=(30, 600))
-            
-            status = response.status_code
-            status_meaning = response.reason
-            # Check for 'Transfer-Encoding: chunked'
-            if (
-                "Transfer-Encoding" in response.headers
-                and response.headers["Transfer-Encoding"] == "chunked"
-            ):
-                logging.warning(
-                    "Server is using 'Transfer-Encoding: chunked'. Content length may not be accurate."
+            if nb_connections > 1 and hasattr(os, "pwrite"):
+                response = session.head(
+                    url, headers=headers, allow_redirects=True, timeout=(30, 600)
                 )
-            if response.ok:
-                total_length = int(
-                    int(response.headers.get("content-length", 0)) / 1000 / 1000
-                )
-                logging.debug("total_length : %s Mo", total_length)
-                try:
-                    for chunk in response.iter_content(chunk_size=chunksize):
-                        if chunk:
-                            f.write(chunk)
-                except ChunkedEncodingError:
-                    status = -1
-                    status_meaning = "ChunkedEncodingError"
-                except Exception as e:
-                    status = -1
-                    status_meaning = f"StreamError: {str(e)}"
-                    logging.error(f"Error streaming content: {e}")
+                total_length_bytes = int(response.headers.get("content-length", 0))
+                # no Range attempt unless the server announces it (otherwise
+                # each connection would start a full-body GET)
+                if (
+                    response.ok
+                    and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+                    and total_length_bytes >= RANGE_DOWNLOAD_MIN_SIZE
+                    and "Content-Encoding" not in response.headers
+                ):
+                    os.ftruncate(f.fileno(), total_length_bytes)
+                    preallocate(f.fileno(), total_length_bytes)
+                    if download_ranges(
+                        session,
+                        headers,
+                        url,
+                        f.fileno(),
+                        total_length_bytes,
+                        nb_connections,
+                    ):
+                        status = 200
+                        status_meaning = "OK"
+                        total_length = int(total_length_bytes / 1000 / 1000)
+                    else:
+                        logging.info("Range requests not served, single stream used.")
+                        os.ftruncate(f.fileno(), 0)
+            if status != 200:
+                # [修改点 2] 添加 timeout 防止挂起 (连接超时30s, 读取超时600s)
+                # the response is closed on exit: its connection goes back to
+                # the pool of the shared session even if the body is not read
+                with session.get(
+                    url, headers=headers, stream=True, timeout=(30, 600)
+                ) as response:
+                    status = response.status_code
+                    status_meaning = response.reason
+                    # Check for 'Transfer-Encoding: chunked'
+                    if (
+                        "Transfer-Encoding" in response.headers
+                        and response.headers["Transfer-Encoding"] == "chunked"
+                    ):
+                        logging.warning(
+                            "Server is using 'Transfer-Encoding: chunked'. Content length may not be accurate."
+                        )
+                    if response.ok:
+                        total_length_bytes = int(
+                            response.headers.get("content-length", 0)
+                        )
+                        total_length = int(total_length_bytes / 1000 / 1000)
+                        logging.debug("total_length : %s Mo", total_length)
+                        if "Content-Encoding" not in response.headers:
+                            preallocate(f.fileno(), total_length_bytes)
+                        try:
+                            stream_to_file(response, f)
+                            # drop preallocated bytes if less data than announced
+                            f.truncate()
+                        except (ChunkedEncodingError, ProtocolError):
+                            status = -1
+                            status_meaning = "ChunkedEncodingError"
+                        except Exception as e:
+                            status = -1
+                            status_meaning = f"StreamError: {str(e)}"
+                            logging.error(f"Error streaming content: {e}")
 
     except Exception as e:
         status = -1
@@ -125,19 +340,15 @@ def CDS_Odata_download_one_product_v2(
             pass
 
     elapsed_time = time.time() - t0
-    
+
     if status == 200:  # means OK download
         if elapsed_time > 0:
             speed = total_length / elapsed_time
         else:
             speed = 0
-            
-        # [修改点 1] 使用 shutil.move 替代 subprocess 调用 mv
+
         try:
-            shutil.move(output_filepath_tmp, output_filepath)
-            # status = subprocess.check_output(
-            #     "mv " + output_filepath_tmp + " " + output_filepath, shell=True
-            # )
+            fast_move(output_filepath_tmp, output_filepath)
             logging.debug("move successful: %s -> %s", output_filepath_tmp, output_filepath)
             os.chmod(output_filepath, 0o0775)
         except Exception as e:
@@ -150,47 +361,70 @@ def CDS_Odata_download_one_product_v2(
     return speed, status_meaning, safename_base, semaphore_token_file
 
 
+def presence_mask(safes, present):
+    """
+    Align a per-product presence dictionary on a series of products.
+
+    Parameters
+    ----------
+    safes (pd.Series): product basenames
+    present (dict): safename -> bool, products missing from the dict are considered absent
+
+    Returns
+    -------
+        mask (pd.Series): True -> the product is present
+    """
+    return pd.Series(
+        [present.get(safe, False) for safe in safes.to_numpy()],
+        index=safes.index,
+        dtype=bool,
+    )
+
+
 def filter_product_already_present(
     cpt, df, outputdir, cdsodatacli_conf, force_download=False
 ):
     """
     Based on a dataframe of products to download, filter those already present locally.
+
+    Each directory (spool, output dir and every archive sub-directory) is listed
+    only once, see check_safes_in_archive/check_safes_in_spool/check_safes_in_outputdir.
     """
+    safes = df["safe"]
+    unique_safes = safes.unique()
 
-    all_output_filepath = []
-    all_urls_to_download = []
-    index_to_download = []
-    for ii, safename_product in enumerate(df["safe"]):
-        to_download = False
-        if force_download:
-            to_download = True
-        if check_safe_in_archive(safename=safename_product, conf=cdsodatacli_conf):
-            cpt["archived_product"] += 1
-        elif check_safe_in_spool(safename=safename_product, conf=cdsodatacli_conf):
-            cpt["in_spool_product"] += 1
-        elif check_safe_in_outputdir(outputdir=outputdir, safename=safename_product):
-            cpt["in_outdir_product"] += 1
-        else:
-            to_download = True
-            cpt["product_absent_from_local_disks"] += 1
-        if to_download:
-            index_to_download.append(ii)
-            id_product = df["id"].iloc[ii]
-            url_product = cdsodatacli_conf["URL_download"] % id_product
-
-            logging.debug("url_product : %s", url_product)
-            logging.debug(
-                "id_product : %s safename_product : %s",
-                id_product,
-                safename_product,
-            )
+    in_archive = presence_mask(
+        safes, check_safes_in_archive(unique_safes, cdsodatacli_conf)
+    )
+    in_spool = ~in_archive & presence_mask(
+        safes, check_safes_in_spool(unique_safes, cdsodatacli_conf)
+    )
+    # zip integrity is only checked for the products not found elsewhere
+    safes_to_check = safes[~in_archive & ~in_spool].unique()
+    if cdsodatacli_conf.get("verify_zip_crc", False):
+        present_in_outdir = verify_safes_in_outputdir(outputdir, safes_to_check)
+    else:
+        present_in_outdir = check_safes_in_outputdir(outputdir, safes_to_check)
+    in_outdir = presence_mask(safes, present_in_outdir)
 
-            output_filepath = os.path.join(outputdir, safename_product + ".zip")
-            all_output_filepath.append(output_filepath)
-            all_urls_to_download.append(url_product)
-    df_todownload = df.iloc[index_to_download].copy()
-    df_todownload["urls"] = all_urls_to_download
-    df_todownload["outputpath"] = all_output_filepath
+    absent = ~(in_archive | in_spool | in_outdir)
+    cpt["archived_product"] += int(in_archive.sum())
+    cpt["in_spool_product"] += int(in_spool.sum())
+    cpt["in_outdir_product"] += int(in_outdir.sum())
+    cpt["product_absent_from_local_disks"] += int(absent.sum())
+
+    if force_download:
+        to_download = pd.Series(True, index=df.index)
+    else:
+        to_download = absent
+    df_todownload = df[to_download].copy()
+    url_tmpl = cdsodatacli_conf["URL_download"]
+    outputdir_prefix = dir_prefix(outputdir)
+    df_todownload["urls"] = [url_tmpl % x for x in df_todownload["id"].to_numpy()]
+    df_todownload["outputpath"] = [
+        outputdir_prefix + x + ".zip" for x in df_todownload["safe"].to_numpy()
+    ]
+    logging.debug("%s products to download", len(df_todownload))
     return df_todownload, cpt
 
 
@@ -226,6 +460,7 @@ def download_list_product_multithread_v2(
     conf = get_conf(path_config_file=cdsodatacli_conf_file)
     if hideProgressBar:
         os.environ["DISABLE_TQDM"] = "True"
+    disable_tqdm = bool(os.environ.get("DISABLE_TQDM", False))
     all_speeds = []
     # status, 0->not treated, -1->error download , 1-> successful download
     df = pd.DataFrame(
@@ -237,124 +472,182 @@ def download_list_product_multithread_v2(
     )
 
     logging.info("%s", cpt)
+    # positions of each product in df2, to update its status without scanning df2
+    safe_to_positions = defaultdict(list)
+    for pos, safe in enumerate(df2["safe"].values):
+        safe_to_positions[safe].append(pos)
+    status_col = df2.columns.get_loc("status")
+    mask_to_treat = df2["status"].to_numpy() == 0
     while_loop = 0
-    blacklist = []
-    while (df2["status"] == 0).any():
-
-        while_loop += 1
-        subset_to_treat = df2[df2["status"] == 0]
-        dfproductDownloaddable = get_sessions_download_available(
-            conf,
-            subset_to_treat,
-            hideProgressBar=True,
-            blacklist=blacklist,
-            logins_group=account_group,
-        )
+    # errors and blacklist are kept from one loop to the next, an account is
+    # blacklisted for BLACKLIST_DURATION seconds, doubled at each new blacklisting
+    # (up to MAX_BLACKLIST_DURATION) until one of its downloads succeeds
+    errors_per_account = defaultdict(int)
+    blacklist_strikes = defaultdict(int)
+    blacklist_until = {}
+    # one pool for the whole download, its threads are reused from one loop to
+    # the next (at most one thread per session slot of the account group)
+    with ThreadPoolExecutor(
+        max_workers=MAX_SESSION_PER_ACCOUNT * max(1, len(conf[account_group]))
+    ) as executor:
+        while mask_to_treat.any():
+
+            while_loop += 1
+            subset_to_treat = df2[mask_to_treat]
+            now = time.time()
+            blacklist = [
+                acco for acco in blacklist_until if blacklist_until[acco] > now
+            ]
+            dfproductDownloaddable = get_sessions_download_available(
+                conf,
+                subset_to_treat,
+                hideProgressBar=True,
+                blacklist=blacklist,
+                logins_group=account_group,
+                max_connections_per_product=MAX_SESSION_PER_ACCOUNT,
+            )
         
-        if len(dfproductDownloaddable) == 0:
-            logging.info("No more sessions/accounts available. Waiting...")
-            time.sleep(10)
-            # Break to avoid infinite loop if really no accounts are working
-            # Or continue if waiting for tokens to expire. 
-            # Ideally logic should be smarter here, but original code would just log and break inner loops.
-            if len(blacklist) >= len(conf[account_group]):
-                 logging.error("All accounts blacklisted. Stopping.")
-                 break
-            continue
-
-        logging.info(
-            "while_loop : %s, prod. to treat: %s, slot avail.:%s, %s",
-            while_loop,
-            len(subset_to_treat),
-            len(dfproductDownloaddable),
-            cpt,
-        )
-        with (
-            ThreadPoolExecutor(max_workers=len(dfproductDownloaddable)) as executor,
-            tqdm(total=len(dfproductDownloaddable)) as pbar,
-        ):
-            future_to_url = {
-                executor.submit(
-                    CDS_Odata_download_one_product_v2,
-                    dfproductDownloaddable["session"].iloc[jj],
-                    dfproductDownloaddable["header"].iloc[jj],
-                    dfproductDownloaddable["url"].iloc[jj],
-                    dfproductDownloaddable["output_path"].iloc[jj],
-                    dfproductDownloaddable["token_semaphore"][jj],
-                    cdsodatacli_conf_file=cdsodatacli_conf_file,
-                ): (jj)
-                for jj in range(len(dfproductDownloaddable))
-            }
-            errors_per_account = defaultdict(int)
-            for future in as_completed(future_to_url):
-                # [修改点 3] 增加 Try-Except 块捕获线程异常
-                try:
-                    (
-                        speed,
-                        status_meaning,
-                        safename_base,
-                        semaphore_token_file,
-                    ) = future.result()
-                    
-                    # remove semaphore once the download is over (successful or not)
-                    login = os.path.basename(semaphore_token_file).split("_")[3]
-                    date_generation_access_token = datetime.datetime.strptime(
-                        os.path.basename(semaphore_token_file)
-                        .split("_")[4]
-                        .replace(".txt", ""),
-                        "%Y%m%dt%H%M%S",
+            if len(dfproductDownloaddable) == 0:
+                if len(blacklist) >= len(conf[account_group]):
+                    waiting_time = (
+                        min(blacklist_until[acco] for acco in blacklist) - now
                     )
-
-                    remove_semaphore_token_file(
-                        token_dir=conf["token_directory"],
-                        login=login,
-                        date_generation_access_token=date_generation_access_token,
-                    )
-                    logging.info("remove session semaphore for %s", login)
-                    remove_semaphore_session_file(
-                        session_dir=conf["active_session_directory"],
-                        safename=safename_base,
-                        login=login,
+                    logging.info(
+                        "All accounts blacklisted. Waiting %1.0f sec...", waiting_time
                     )
-
-                    if status_meaning == "OK":
-                        df2.loc[(df2["safe"] == safename_base), "status"] = 1
-                        all_speeds.append(speed)
-                        cpt["successful_download"] += 1
-                    else:
-                        df2.loc[(df2["safe"] == safename_base), "status"] = -1
-                        errors_per_account[login] += 1
-                        logging.info("error found for %s meaning %s", login, status_meaning)
-                    
-                    cpt["status_%s" % status_meaning] += 1
-
-                except Exception as e:
-                    # 获取该 future 对应的索引，以便清理资源
-                    jj = future_to_url[future]
-                    safename_err = dfproductDownloaddable["safe"].iloc[jj]
-                    session_sem_err = dfproductDownloaddable["session_semaphore"].iloc[jj]
+                    time.sleep(max(waiting_time, 0))
+                else:
+                    logging.info("No more sessions/accounts available. Waiting...")
+                    time.sleep(10)
+                continue
+
+            logging.info(
+                "while_loop : %s, prod. to treat: %s, slot avail.:%s, %s",
+                while_loop,
+                len(subset_to_treat),
+                len(dfproductDownloaddable),
+                cpt,
+            )
+            with tqdm(
+                total=len(dfproductDownloaddable),
+                disable=disable_tqdm,
+                mininterval=0.5,
+                miniters=max(1, len(dfproductDownloaddable) // 50),
+                smoothing=0,
+            ) as pbar:
+                future_to_url = {
+                    executor.submit(
+                        CDS_Odata_download_one_product_v2,
+                        dfproductDownloaddable["session"].iloc[jj],
+                        dfproductDownloaddable["header"].iloc[jj],
+                        dfproductDownloaddable["url"].iloc[jj],
+                        dfproductDownloaddable["output_path"].iloc[jj],
+                        dfproductDownloaddable["token_semaphore"][jj],
+                        cdsodatacli_conf_file=cdsodatacli_conf_file,
+                        nb_connections=int(
+                            dfproductDownloaddable["nb_connections"].iloc[jj]
+                        ),
+                    ): (jj)
+                    for jj in range(len(dfproductDownloaddable))
+                }
+                for future in as_completed(future_to_url):
+                    # [修改点 3] 增加 Try-Except 块捕获线程异常
+                    try:
+                        (
+                            speed,
+                            status_meaning,
+                            safename_base,
+                            semaphore_token_file,
+                        ) = future.result()
                     
-                    logging.error(f"Critical error in download thread for {safename_err}: {e}")
-                    logging.error(traceback.format_exc())
+                        # remove semaphore once the download is over (successful or not)
+                        login = os.path.basename(semaphore_token_file).split("_")[3]
+                        date_generation_access_token = parse_token_date(
+                            os.path.basename(semaphore_token_file)[-19:-4]
+                        )
+
+                        remove_semaphore_token_file(
+                            token_dir=conf["token_directory"],
+                            login=login,
+                            date_generation_access_token=date_generation_access_token,
+                        )
+                        logging.info("remove session semaphore for %s", login)
+                        remove_semaphore_session_file(
+                            session_dir=conf["active_session_directory"],
+                            safename=safename_base,
+                            login=login,
+                        )
+                        # sessions of the additional Range connections
+                        remove_semaphore_session_file(
+                            session_dir=conf["active_session_directory"],
+                            safename=extra_session_safename(safename_base, "*"),
+                            login=login,
+                        )
+
+                        if status_meaning == "OK":
+                            new_status = 1
+                            all_speeds.append(speed)
+                            cpt["successful_download"] += 1
+                            errors_per_account[login] = 0
+                            blacklist_strikes[login] = 0
+                        else:
+                            new_status = -1
+                            errors_per_account[login] += 1
+                            logging.info(
+                                "error found for %s meaning %s", login, status_meaning
+                            )
+
+                        cpt["status_%s" % status_meaning] += 1
+                        for pos in safe_to_positions[safename_base]:
+                            df2.iat[pos, status_col] = new_status
+                            mask_to_treat[pos] = False
+
+                    except Exception as e:
+                        # 获取该 future 对应的索引，以便清理资源
+                        jj = future_to_url[future]
+                        safename_err = dfproductDownloaddable["safe"].iloc[jj]
+                        session_sem_err = dfproductDownloaddable[
+                            "session_semaphore"
+                        ].iloc[jj]
+
+                        logging.error(
+                            f"Critical error in download thread for {safename_err}: {e}"
+                        )
+                        logging.error(traceback.format_exc())
                     
-                    # 标记为失败
-                    df2.loc[(df2["safe"] == safename_err), "status"] = -1
-                    cpt["status_Exception"] += 1
+                        # 标记为失败
+                        for pos in safe_to_positions[safename_err]:
+                            df2.iat[pos, status_col] = -1
+                            mask_to_treat[pos] = False
+                        cpt["status_Exception"] += 1
                     
-                    # 尝试清理 session semaphore 以释放插槽
-                    if os.path.exists(session_sem_err):
-                        try:
-                            os.remove(session_sem_err)
-                            logging.debug(f"Cleaned up session semaphore for failed download: {session_sem_err}")
-                        except OSError:
-                            pass
-
-                pbar.update(1)
+                        # 尝试清理 session semaphore 以释放插槽
+                        if os.path.exists(session_sem_err):
+                            try:
+                                os.remove(session_sem_err)
+                                list_active_session_files.cache_clear()
+                                logging.debug(
+                                    f"Cleaned up session semaphore for failed download: {session_sem_err}"
+                                )
+                            except OSError:
+                                pass
+                        remove_semaphore_session_file(
+                            session_dir=conf["active_session_directory"],
+                            safename=extra_session_safename(safename_err, "*"),
+                        )
+
+                    pbar.update(1)
             
-            for acco in errors_per_account:
-                if errors_per_account[acco] >= MAX_SESSION_PER_ACCOUNT:
-                    blacklist.append(acco)
-                    logging.info("%s black listed for next loops", acco)
+                for acco in errors_per_account:
+                    if errors_per_account[acco] >= MAX_SESSION_PER_ACCOUNT:
+                        errors_per_account[acco] = 0
+                        blacklist_strikes[acco] += 1
+                        duration = min(
+                            BLACKLIST_DURATION * 2 ** (blacklist_strikes[acco] - 1),
+                            MAX_BLACKLIST_DURATION,
+                        )
+                        blacklist_until[acco] = time.time() + duration
+                        logging.info("%s black listed for %s sec", acco, duration)
                     
     logging.info("download over.")
     logging.info("counter: %s", cpt)
@@ -402,19 +695,18 @@ def download_list_product(
             quiet=hideProgressBar,
             specific_account=specific_account,
             passwd=specific_passwd,
+            conf=conf,
         )
     else:  # select randomly one token among existing
         path_semphore_token = random.choice(lst_usable_tokens)
-        date_generation_access_token = datetime.datetime.strptime(
-            os.path.basename(path_semphore_token).split("_")[4].replace(".txt", ""),
-            "%Y%m%dt%H%M%S",
+        date_generation_access_token = parse_token_date(
+            os.path.basename(path_semphore_token)[-19:-4]
         )
         access_token = open(path_semphore_token).readlines()[0]
     if access_token is not None:
         headers = {"Authorization": "Bearer %s" % access_token}
         logging.debug("headers: %s", headers)
-        session = requests.Session()
-        session.headers.update(headers)
+        session = get_session(specific_account, access_token=access_token, conf=conf)
         if hideProgressBar:
             os.environ["DISABLE_TQDM"] = "True"
 
@@ -448,9 +740,13 @@ def download_list_product(
                         date_generation_access_token,
                         specific_account,
                         path_semphore_token,
-                    ) = get_bearer_access_token(specific_account=specific_account)
+                    ) = get_bearer_access_token(
+                        specific_account=specific_account, conf=conf
+                    )
                     headers = {"Authorization": "Bearer %s" % access_token}
-                    session.headers.update(headers)
+                    session = get_session(
+                        specific_account, access_token=access_token, conf=conf
+                    )
                 else:
                     logging.debug("reuse same access token, still valid.")
                 output_filepath = os.path.join(outputdir, safename_product + ".zip")
@@ -558,4 +854,4 @@ def main():
         cdsodatacli_conf_file=args.cdsodatacli_conf_file,
     )
     elapsed = t0 - time.time()
-    logging.info("end of function in %s seconds", elapsed)
\ No newline at end of file
+    logging.info("end of function in %s seconds", elapsed)
@@ -1,13 +1,36 @@
-from cdsodatacli.utils import get_conf
+from cdsodatacli.utils import get_conf, json_loads, ttl_cache, SEMAPHORE_LISTING_TTL
 import requests
 import logging
 import json
 import datetime
 import os
-import glob
 import random
 
 MAX_VALIDITY_ACCESS_TOKEN = 600  # sec (defined by CDS API)
+# token file name -> generation date, memo of the previous token directory listing
+_token_dates_seen = {}
+
+
+def parse_token_date(date_str):
+    """
+    Fast parsing of the generation date stored in token file names (format %Y%m%dt%H%M%S)
+
+    Parameters
+    ----------
+    date_str (str): e.g. 20231110t201811
+
+    Returns
+    -------
+        date (datetime.datetime)
+    """
+    return datetime.datetime(
+        int(date_str[0:4]),
+        int(date_str[4:6]),
+        int(date_str[6:8]),
+        int(date_str[9:11]),
+        int(date_str[11:13]),
+        int(date_str[13:15]),
+    )
 
 
 def get_bearer_access_token(
@@ -87,7 +110,7 @@ def get_bearer_access_token(
         # 检查 HTTP 响应状态码
         response.raise_for_status()
         
-        data = response.json()
+        data = json_loads(response.content)
         
     except requests.exceptions.RequestException as e:
         logging.error(f"Error fetching token for {login}: {e}")
@@ -148,52 +171,81 @@ def write_token_semphore_file(
     except IOError as e:
         logging.error(f"Failed to write token file {path_semphore_token}: {e}")
         return None
+    list_token_files.cache_clear()
         
     return path_semphore_token
 
 
-def get_list_of_exising_token(token_dir, account=None):
+@ttl_cache(SEMAPHORE_LISTING_TTL)
+def list_token_files(token_dir, account=None):
     """
+    The listing is memoized for SEMAPHORE_LISTING_TTL seconds (reset when a token file is written or removed).
+
     Parameters
         token_dir (str)
         account (str): optional
 
     Returns
     -------
-        lst_token (list)
+        token_files (list): (path, generation date) of the token files
     """
+    global _token_dates_seen
     if account is not None:
-        lst_token0 = glob.glob(
-            os.path.join(token_dir, "CDSE_access_token_%s_*.txt" % account)
-        )
+        prefix = "CDSE_access_token_%s_" % account
     else:
-        lst_token0 = glob.glob(os.path.join(token_dir, "CDSE_access_token_*.txt"))
+        prefix = "CDSE_access_token_"
+    token_dates = {}
+    token_files = []
+    try:
+        with os.scandir(token_dir) as it:
+            for entry in it:
+                filename = entry.name
+                if filename in _token_dates_seen:
+                    date_generation_access_token = _token_dates_seen[filename]
+                    token_dates[filename] = date_generation_access_token
+                if not (filename.startswith(prefix) and filename.endswith(".txt")):
+                    continue
+                if filename not in _token_dates_seen:
+                    # CDSE_access_token_<login>_<%Y%m%dt%H%M%S>.txt
+                    try:
+                        date_generation_access_token = parse_token_date(
+                            filename[-19:-4]
+                        )
+                    except ValueError:
+                        logging.warning(
+                            "Skipping malformed or unrelated token file: %s",
+                            entry.path,
+                        )
+                        date_generation_access_token = None
+                    token_dates[filename] = date_generation_access_token
+                if date_generation_access_token is not None:
+                    token_files.append((entry.path, date_generation_access_token))
+    except FileNotFoundError:
+        pass
+    # only keep the files still on disk, so the memo does not grow forever
+    _token_dates_seen = token_dates
+    return token_files
 
-    lst_token = []
-    for ll in lst_token0:
-        try:
-            # 增加解析安全性
-            filename = os.path.basename(ll)
-            # 假设文件名格式为 CDSE_access_token_EMAIL_DATETIME.txt
-            # split("_")可能会有问题如果email包含下划线，但原逻辑是用索引4
-            # 更加稳健的做法是取倒数第一个部分作为日期
-            parts = filename.replace(".txt", "").split("_")
-            if len(parts) < 2:
-                continue
-                
-            date_str = parts[-1] 
-            date_generation_access_token = datetime.datetime.strptime(
-                date_str, "%Y%m%dt%H%M%S"
-            )
-            
-            if (
-                datetime.datetime.today() - date_generation_access_token
-            ).total_seconds() < MAX_VALIDITY_ACCESS_TOKEN:
-                lst_token.append(ll)
-        except (IndexError, ValueError):
-            logging.warning(f"Skipping malformed or unrelated token file: {ll}")
-            continue
-            
+
+def get_list_of_exising_token(token_dir, account=None):
+    """
+
+    Parameters
+        token_dir (str)
+        account (str): optional
+
+    Returns
+    -------
+        lst_token (list): paths of the token files still valid
+    """
+    # the validity is checked at each call, the listing may be a few moments old
+    now = datetime.datetime.today()
+    lst_token = [
+        path
+        for path, date_generation_access_token in list_token_files(token_dir, account)
+        if (now - date_generation_access_token).total_seconds()
+        < MAX_VALIDITY_ACCESS_TOKEN
+    ]
     logging.debug("Number of valid tokens found: %s", len(lst_token))
     return lst_token
 
@@ -217,4 +269,5 @@ def remove_semaphore_token_file(token_dir, login, date_generation_access_token):
             os.remove(path_token)
             logging.debug("token semaphore file removed")
         except OSError:
-            pass
\ No newline at end of file
+            pass
+        list_token_files.cache_clear()
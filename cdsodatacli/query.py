@@ -22,6 +22,7 @@ import traceback
 import warnings
 from geodatasets import get_path
 import numpy as np
+from cdsodatacli.utils import json_loads
 
 DEFAULT_TOP_ROWS_PER_QUERY = 1000
 
@@ -574,8 +575,8 @@ def fetch_one_url(url, cpt, index, cache_dir):
         if os.path.exists(cache_file):
             cpt["cache_used"] += 1
             logging.debug("cache file exists: %s", cache_file)
-            with open(cache_file, "r") as f:
-                json_data = json.load(f)
+            with open(cache_file, "rb") as f:
+                json_data = json_loads(f.read())
                 collected_data = process_data(json_data)
     if (
         json_data is None
@@ -583,7 +584,7 @@ def fetch_one_url(url, cpt, index, cache_dir):
         logging.debug("no cache file -> go for query CDS")
         cpt["urls_tested"] += 1
         try:
-            json_data = requests.get(url).json()
+            json_data = json_loads(requests.get(url).content)
             cpt["urls_OK"] += 1
         except KeyboardInterrupt:
             raise ("keyboard interrupt")
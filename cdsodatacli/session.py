@@ -3,24 +3,100 @@ import logging
 import random
 import glob
 
+import socket
+
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from collections import defaultdict
 from cdsodatacli.fetch_access_token import (
     get_list_of_exising_token,
     get_bearer_access_token,
 )
+from cdsodatacli.utils import ttl_cache, SEMAPHORE_LISTING_TTL
 
 MAX_SESSION_PER_ACCOUNT = 4  # each account CDSE have maximum 4 active sessions
 
+# one requests.Session per CDSE login, shared by all the downloads of this login
+# so that the TCP+TLS connections to the CDSE endpoints are reused.
+_sessions_by_login = {}
+
+
+class SocketOptionsHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter opening its sockets with a larger receive buffer (SO_RCVBUF),
+    so that the TCP window can fill long and fat links to the CDSE.
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ["socket_rcvbuf_mb"]
+
+    def __init__(self, socket_rcvbuf_mb=None, **kwargs):
+        # set before HTTPAdapter.__init__ which calls init_poolmanager
+        self.socket_rcvbuf_mb = socket_rcvbuf_mb
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = list(HTTPConnection.default_socket_options)  # TCP_NODELAY
+        if self.socket_rcvbuf_mb:
+            socket_options.append(
+                (
+                    socket.SOL_SOCKET,
+                    socket.SO_RCVBUF,
+                    int(self.socket_rcvbuf_mb * 1024 * 1024),
+                )
+            )
+        kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_session(login, access_token=None, conf=None):
+    """
+    Get the (shared) requests.Session of a CDSE login, created at first call.
+    A new access token only rotates the Authorization header: the connection pool is kept.
+
+    Parameters
+    ----------
+    login (str): CDSE account (email address)
+    access_token (str): [optional] token to set as default Authorization header of the session
+    conf (dict): [optional] configuration, its "socket_rcvbuf_mb" key sets the socket receive buffer (Mo) of a new session
+
+    Returns
+    -------
+        session (requests.Session): session with a connection pool sized for MAX_SESSION_PER_ACCOUNT downloads
+    """
+    session = _sessions_by_login.get(login)
+    if session is None:
+        session = requests.Session()
+        if conf is None:
+            conf = {}
+        adapter = SocketOptionsHTTPAdapter(
+            socket_rcvbuf_mb=conf.get("socket_rcvbuf_mb"),
+            pool_connections=MAX_SESSION_PER_ACCOUNT,
+            pool_maxsize=MAX_SESSION_PER_ACCOUNT * 2,
+            pool_block=False,
+        )
+        session.mount("https://", adapter)
+        session = _sessions_by_login.setdefault(login, session)
+    if access_token is not None:
+        session.headers["Authorization"] = "Bearer %s" % access_token
+    return session
+
+
+@ttl_cache(SEMAPHORE_LISTING_TTL)
+def list_active_session_files(session_dir):
+    """
+    List the active session semaphore files of a directory.
+    The listing is memoized for SEMAPHORE_LISTING_TTL seconds (reset when a session file is written or removed).
+    """
+    return glob.glob(os.path.join(session_dir, "CDSE_active_session_*.txt"))
+
 
 def get_list_active_session(conf, login_group=None):
     """
     Method to get the list of active session semaphore files.
     """
-    lst_sessions = glob.glob(
-        os.path.join(conf["active_session_directory"], "CDSE_active_session_*.txt")
-    )
+    lst_sessions = list_active_session_files(conf["active_session_directory"])
 
     if login_group is not None:
         consolidated_active_session_semaphore = []
@@ -57,6 +133,14 @@ def get_a_free_account(counts, blacklist=None):
     return candidate, counts
 
 
+def extra_session_safename(safename, connection_index):
+    """
+    Name used in the semaphore file of an additional session (HTTP Range connection) of a product download.
+    remove_semaphore_session_file(session_dir, extra_session_safename(safename, "*"), login) removes them all.
+    """
+    return "%s_connection%s" % (safename, connection_index)
+
+
 def write_active_session_semphore_file(safename, login, session_dir):
     path_semphore_session = os.path.join(
         session_dir,
@@ -64,6 +148,7 @@ def write_active_session_semphore_file(safename, login, session_dir):
     )
     fid = open(path_semphore_session, "w")
     fid.close()
+    list_active_session_files.cache_clear()
     return path_semphore_session
 
 
@@ -84,14 +169,24 @@ def remove_semaphore_session_file(session_dir, safename=None, login=None):
     lst = glob.glob(path_semphore_session)
     for llu in lst:
         os.remove(llu)
+    list_active_session_files.cache_clear()
     logging.debug("session semaphore file removed")
 
 
 def get_sessions_download_available(
-    conf, subset_to_treat, hideProgressBar=True, blacklist=None, logins_group="logins"
+    conf,
+    subset_to_treat,
+    hideProgressBar=True,
+    blacklist=None,
+    logins_group="logins",
+    max_connections_per_product=1,
 ):
     """
     Returns dataframe of downloadable products with allocated sessions.
+
+    When there are more free session slots than products, the spare slots of an account
+    are given to its products (up to max_connections_per_product sessions per product,
+    one semaphore file per extra session), see column nb_connections.
     """
     df_products_downloadable = pd.DataFrame()
     all_sessions = []
@@ -128,9 +223,16 @@ def get_sessions_download_available(
             lst_usable_tokens = get_list_of_exising_token(
                 token_dir=conf["token_directory"], account=account_free
             )
-            if (
-                lst_usable_tokens == []
-            ):  # in case no token ready to be used -> create new one
+            access_token = None
+            if lst_usable_tokens != []:  # select randomly one token among existing
+                path_semphore_token = random.choice(lst_usable_tokens)
+                try:
+                    with open(path_semphore_token) as f:
+                        access_token = f.readlines()[0]
+                except FileNotFoundError:
+                    # removed by another process since the (memoized) listing
+                    logging.debug("token file gone: %s", path_semphore_token)
+            if access_token is None:  # no token ready to be used -> create new one
                 (
                     access_token,
                     date_generation_access_token,
@@ -140,11 +242,8 @@ def get_sessions_download_available(
                     quiet=hideProgressBar,
                     specific_account=account_free,
                     account_group=logins_group,
-                    conf=conf, # 修复 Bug: 传递 conf
+                    conf=conf,  # 修复 Bug: 传递 conf
                 )
-            else:  # select randomly one token among existing
-                path_semphore_token = random.choice(lst_usable_tokens)
-                access_token = open(path_semphore_token).readlines()[0]
             if access_token is not None:
                 bunch_product_downloadable.append(safename_product)
                 bunch_urls_to_download.append(subset_to_treat["urls"].iloc[ss])
@@ -159,13 +258,24 @@ def get_sessions_download_available(
                 )
                 headers = {"Authorization": "Bearer %s" % access_token}
                 logging.debug("headers: %s", headers)
-                session = requests.Session()
-                session.headers.update(headers)
+                # the Authorization header is given per request, the session is shared
+                session = get_session(account_free, conf=conf)
                 all_sessions.append(session)
                 all_headers.append(headers)
                 all_semaphores.append(path_semphore_token)
                 all_safe_basename.append(safename_product)
                 all_session_semaphores.append(path_semaphore_session)
+    nb_connections = [1] * len(all_safe_basename)
+    for _ in range(max_connections_per_product - 1):
+        for ii, account in enumerate(usable_accounts):
+            if account_counter[account] < MAX_SESSION_PER_ACCOUNT:
+                account_counter[account] += 1
+                write_active_session_semphore_file(
+                    extra_session_safename(all_safe_basename[ii], nb_connections[ii]),
+                    login=account,
+                    session_dir=conf["active_session_directory"],
+                )
+                nb_connections[ii] += 1
     df_products_downloadable["session"] = all_sessions
     df_products_downloadable["header"] = all_headers
     df_products_downloadable["token_semaphore"] = all_semaphores
@@ -173,4 +283,5 @@ def get_sessions_download_available(
     df_products_downloadable["output_path"] = outputfiles_download_coming
     df_products_downloadable["session_semaphore"] = all_session_semaphores
     df_products_downloadable["safe"] = all_safe_basename
+    df_products_downloadable["nb_connections"] = nb_connections
     return df_products_downloadable
\ No newline at end of file
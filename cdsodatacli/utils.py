@@ -2,21 +2,96 @@ from yaml import load
 import logging
 import os
 import cdsodatacli
-from yaml import Loader
+
+try:
+    from yaml import CSafeLoader as Loader  # libyaml based, much faster
+except ImportError:
+    from yaml import SafeLoader as Loader
 import datetime
-import pandas as pd
-import json
+import csv
 import zipfile  # 新增导入用于完整性检查
+import functools
+import time
+import copy
+import threading
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is an optional dependency
+    from json import loads as json_loads
+try:
+    import ijson
+except ImportError:  # ijson is an optional dependency
+    ijson = None
+
+# bytes, bigger OpenSearch files are parsed incrementally
+JSON_STREAMING_MIN_SIZE = 50 * 1024 * 1024
+MAX_WORKERS_DISK_CHECK = 32  # threads verifying products already on disk
+# sec, lifetime of the memoized token/session directory listings
+SEMAPHORE_LISTING_TTL = 1.0
+
+
+def ttl_cache(ttl):
+    """
+    Memoize the results of a function for ttl seconds (per hashable arguments).
+    The decorated function gets a cache_clear() method, to call when the underlying data change.
+
+    Parameters
+    ----------
+    ttl (float): time to live of a result in seconds
+
+    Returns
+    -------
+        decorator (function)
+    """
+
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            hit = cache.get(key)
+            if hit is not None and now - hit[0] < ttl:
+                return hit[1]
+            result = func(*args, **kwargs)
+            cache[key] = (now, result)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
 
-local_config_potential_path = os.path.join(
-    os.path.dirname(cdsodatacli.__file__), "localconfig.yml"
-)
-config_path = os.path.join(os.path.dirname(cdsodatacli.__file__), "config.yml")
+@functools.cache
+def _local_config_path():
+    # resolved on first use rather than at import time
+    return os.path.join(os.path.dirname(cdsodatacli.__file__), "localconfig.yml")
+
+
+@functools.cache
+def _pkg_config_path():
+    return os.path.join(os.path.dirname(cdsodatacli.__file__), "config.yml")
+
+
+# config file path -> (modification time in ns, parsed configuration)
+_CONF_CACHE = {}
+# directory -> (modification time in ns, names of its entries)
+_dir_listing_cache = {}
+# zip path -> (size, modification time in ns, CRC verified) of the last successful check, LRU ordered
+_ZIP_VERIFIED = OrderedDict()
+_ZIP_VERIFIED_MAX_SIZE = 65536
+_zip_verified_lock = threading.Lock()
 
 
 def get_conf(path_config_file=None) -> dict:
     """
     Load configuration from localconfig.yml or config.yml in cdsodatacli package directory.
+    The parsed file is memoized until its modification time changes.
     
     Priority order:
     1. path_config_file (if provided)
@@ -34,73 +109,363 @@ def get_conf(path_config_file=None) -> dict:
     cwd_config = os.path.join(os.getcwd(), "localconfig.yml")
 
     if path_config_file is not None:
-        used_config_path = path_config_file
-        assert os.path.exists(used_config_path), f"{used_config_path} does not exist"
-    elif os.path.exists(cwd_config):
-        used_config_path = cwd_config  # 命中当前目录配置
+        candidates = (path_config_file,)
     else:
-        if os.path.exists(local_config_potential_path):
-            used_config_path = local_config_potential_path
-        else:
-            used_config_path = config_path
-            
+        candidates = (cwd_config, _local_config_path(), _pkg_config_path())
+    # EAFP: opening each candidate in priority order replaces the exists() probes
+    for used_config_path in candidates:
+        try:
+            stream = open(used_config_path, "rb")
+        except FileNotFoundError:
+            continue
+        break
+    else:
+        raise AssertionError(f"{used_config_path} does not exist")
+
     logging.debug("config path that is used: %s", used_config_path)
-    stream = open(used_config_path, "r")
-    conf = load(stream, Loader=Loader)
-    return conf
+    with stream:
+        used_config_path = os.path.abspath(used_config_path)
+        mtime = os.fstat(stream.fileno()).st_mtime_ns
+        cached = _CONF_CACHE.get(used_config_path)
+        if cached is not None and cached[0] == mtime:
+            conf = cached[1]
+        else:
+            conf = load(stream, Loader=Loader)
+            _CONF_CACHE[used_config_path] = (mtime, conf)
+    # shallow copy: callers can set keys without altering the memoized configuration
+    return copy.copy(conf)
 
 
-def check_safe_in_outputdir(outputdir, safename):
+def get_names_in_dir(directory):
     """
-    Check if the SAFE product exists in the output directory and verify its integrity if it is a zip file.
+    List the entries of a directory with a single os.scandir call.
 
     Parameters
     ----------
-    safename (str) basename
+    directory (str)
 
     Returns
     -------
-        present_in_outputdir (bool): True -> the product is already in the output dir and valid
+        names (set): basenames of the entries (empty if the directory does not exist)
     """
-    present_in_outdir = False
-    potential_file = None
-    
+    try:
+        with os.scandir(directory) as it:
+            names = {entry.name for entry in it}
+    except (FileNotFoundError, NotADirectoryError):
+        names = set()
+    return names
+
+
+def _safe_candidates(safename):
+    """
+    Basenames under which a product can be stored: <safe>.zip, <safe> and, for .SAFE names, <name>.zip
+    """
+    candidates = [safename + ".zip", safename]
+    if safename.endswith(".SAFE"):
+        candidates.append(safename[:-5] + ".zip")
+    return candidates
+
+
+def dir_prefix(directory):
+    """
+    Directory with a trailing separator, so that paths of its entries are built by plain concatenation
+    (several times faster than os.path.join in loops over many products).
+
+    Parameters
+    ----------
+    directory (str or os.PathLike)
+
+    Returns
+    -------
+        prefix (str): e.g. /data/spool/ (empty string kept as is, i.e. current directory)
+    """
+    directory = os.fspath(directory)
+    if not directory or directory.endswith(os.sep):
+        return directory
+    return directory + os.sep
+
+
+def _exists(path):
+    # access() is cheaper than the stat() behind os.path.exists
+    return os.access(path, os.F_OK)
+
+
+# kinds of directory entries in the listing cache
+ENTRY_DIR = 0
+ENTRY_FILE = 1
+ENTRY_OTHER = 2
+
+
+def _scan_dir_kinds(directory):
+    """
+    List the entries of a directory with their kind, the kind coming from the d_type returned by the
+    kernel along with the names (no extra stat per entry).
+
+    Parameters
+    ----------
+    directory (str)
+
+    Returns
+    -------
+        kinds (dict): basename -> ENTRY_DIR, ENTRY_FILE or ENTRY_OTHER
+    """
+    kinds = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                kinds[entry.name] = ENTRY_FILE
+            elif entry.is_dir(follow_symlinks=False):
+                kinds[entry.name] = ENTRY_DIR
+            else:
+                kinds[entry.name] = ENTRY_OTHER
+    return kinds
+
+
+def _listdir_cached(directory):
+    """
+    Entries of a directory with their kind, memoized until the directory modification time changes.
+
+    Parameters
+    ----------
+    directory (str)
+
+    Returns
+    -------
+        kinds (dict): basename -> ENTRY_DIR, ENTRY_FILE or ENTRY_OTHER (empty if the directory does not exist), not to be modified
+    """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+        cached = _dir_listing_cache.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        kinds = _scan_dir_kinds(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+    _dir_listing_cache[directory] = (mtime, kinds)
+    return kinds
+
+
+def _verify_zip(path):
+    """
+    Decompress every member of a zip to verify its CRC (zlib releases the GIL, this scales with threads).
+
+    Parameters
+    ----------
+    path (str): full path of the zip
+
+    Returns
+    -------
+        valid (bool): True -> no corrupted member
+    """
+    with zipfile.ZipFile(path, "r") as zf:
+        # testzip 返回 None 表示无错误，否则返回第一个损坏文件的名称
+        return zf.testzip() is None
+
+
+# the End Of Central Directory record (22 bytes + up to 64 KiB of comment) closes every zip
+_ZIP_EOCD_SIGNATURE = b"PK\x05\x06"
+_ZIP_EOCD_MAX_SIZE = 22 + 65535
+
+
+def _zip_tail_ok(path):
+    """
+    Cheap integrity probe of a zip: look for the End Of Central Directory signature in its last bytes.
+    A download truncated mid-transfer has no EOCD record, detected with a single small read.
+
+    Parameters
+    ----------
+    path (str): full path of the zip
+
+    Returns
+    -------
+        valid (bool): True -> the EOCD record is present
+    """
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - _ZIP_EOCD_MAX_SIZE))
+        tail = f.read()
+    return tail.rfind(_ZIP_EOCD_SIGNATURE) != -1
+
+
+def _check_zip_in_outputdir(outputdir, potential_file, verify_crc):
+    """
+    Verify the integrity of a zip product found in the output directory, removing it if corrupted.
+
+    Parameters
+    ----------
+    outputdir (str)
+    potential_file (str): full path of the zip
+    verify_crc (bool): True -> decompress every member of the zip to verify its CRC (slow), False -> only look for the end of central directory record
+
+    Returns
+    -------
+        valid (bool)
+    """
+    try:
+        st = os.stat(potential_file)
+        with _zip_verified_lock:
+            verified = _ZIP_VERIFIED.get(potential_file)
+            if verified is not None:
+                _ZIP_VERIFIED.move_to_end(potential_file)
+        # a zip unchanged since its last successful check is not read again
+        if (
+            verified is not None
+            and verified[:2] == (st.st_size, st.st_mtime_ns)
+            and (verified[2] or not verify_crc)
+        ):
+            return True
+        if verify_crc:
+            if not _verify_zip(potential_file):
+                raise zipfile.BadZipFile("Corrupted file content inside zip")
+        elif not _zip_tail_ok(potential_file):
+            raise zipfile.BadZipFile(
+                "End of central directory not found (truncated file)"
+            )
+        with _zip_verified_lock:
+            _ZIP_VERIFIED[potential_file] = (st.st_size, st.st_mtime_ns, verify_crc)
+            _ZIP_VERIFIED.move_to_end(potential_file)
+            if len(_ZIP_VERIFIED) > _ZIP_VERIFIED_MAX_SIZE:
+                _ZIP_VERIFIED.popitem(last=False)
+        valid = True
+    except (zipfile.BadZipFile, OSError) as e:
+        with _zip_verified_lock:
+            _ZIP_VERIFIED.pop(potential_file, None)
+        logging.warning(
+            "Found corrupted file %s, removing it: %s",
+            os.path.basename(potential_file),
+            e,
+        )
+        try:
+            os.remove(potential_file)
+        except OSError:
+            pass
+        _dir_listing_cache.pop(outputdir, None)
+        valid = False
+    return valid
+
+
+def check_safes_in_outputdir(outputdir, safenames, verify_crc=False, max_workers=None):
+    """
+    Check which SAFE products exist in the output directory, the directory being listed once.
+    Zip files found are checked for integrity (in threads, this is blocking I/O) and removed if corrupted.
+
+    Parameters
+    ----------
+    outputdir (str)
+    safenames (iterable of str) basenames
+    verify_crc (bool): True -> decompress every member of the zip to verify its CRC (slow), False -> only look for the end of central directory record
+    max_workers (int): number of threads checking the zip files [optional, default is MAX_WORKERS_DISK_CHECK or the number of CPUs if verify_crc]
+
+    Returns
+    -------
+        present_in_outdir (dict): safename -> True if the product is already in the output dir and valid
+    """
+    present_in_outdir = {}
+    zips_to_check = {}
+
     # 检查可能的文件名变体
-    candidates = [
-        os.path.join(outputdir, safename + ".zip"),
-        os.path.join(outputdir, safename),
-        os.path.join(outputdir, safename.replace(".SAFE", ".zip"))
-    ]
-
-    for f in candidates:
-        if os.path.exists(f):
-            potential_file = f
+    kinds = _listdir_cached(outputdir)
+    outputdir_prefix = dir_prefix(outputdir)
+    for safename in safenames:
+        present_in_outdir[safename] = False
+        for candidate in _safe_candidates(safename):
+            kind = kinds.get(candidate)
+            if kind is None:
+                continue
+            # known directories (unpacked products) need no zip probe, symlinks are still probed
+            if kind != ENTRY_DIR and candidate.endswith(".zip"):
+                # 如果是 ZIP 文件，进行完整性检查
+                zips_to_check[safename] = outputdir_prefix + candidate
+            else:
+                # 对于非 zip (如解压后的 .SAFE 目录)，暂只检查存在性
+                present_in_outdir[safename] = True
             break
-    
-    if potential_file:
-        # 如果是 ZIP 文件，进行完整性检查
-        if potential_file.endswith(".zip"):
-            try:
-                with zipfile.ZipFile(potential_file, 'r') as zf:
-                    # testzip 返回 None 表示无错误，否则返回第一个损坏文件的名称
-                    if zf.testzip() is not None:
-                        raise zipfile.BadZipFile("Corrupted file content inside zip")
-                present_in_outdir = True
-            except (zipfile.BadZipFile, OSError) as e:
-                logging.warning(f"Found corrupted file {os.path.basename(potential_file)}, removing it: {e}")
-                try:
-                    os.remove(potential_file)
-                except OSError:
-                    pass
-                present_in_outdir = False
-        else:
-            # 对于非 zip (如解压后的 .SAFE 目录)，暂只检查存在性
-            present_in_outdir = True
 
+    if len(zips_to_check) == 1:
+        safename, potential_file = zips_to_check.popitem()
+        present_in_outdir[safename] = _check_zip_in_outputdir(
+            outputdir, potential_file, verify_crc
+        )
+    elif zips_to_check:
+        if max_workers is None:
+            # the structure check waits on I/O, the CRC check is CPU bound
+            max_workers = (
+                (os.cpu_count() or 1) if verify_crc else MAX_WORKERS_DISK_CHECK
+            )
+        with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(zips_to_check))
+        ) as executor:
+            valids = executor.map(
+                lambda potential_file: _check_zip_in_outputdir(
+                    outputdir, potential_file, verify_crc
+                ),
+                zips_to_check.values(),
+            )
+            present_in_outdir.update(zip(zips_to_check, valids))
+    return present_in_outdir
+
+
+def verify_safes_in_outputdir(outputdir, safenames, max_workers=None):
+    """
+    Bulk verification of the CRC of every zip product of the output directory, spread over threads.
+    Corrupted zip files are removed.
+
+    Parameters
+    ----------
+    outputdir (str)
+    safenames (iterable of str) basenames
+    max_workers (int): number of verification threads [optional, default is the number of CPUs]
+
+    Returns
+    -------
+        present_in_outdir (dict): safename -> True if the product is in the output dir and not corrupted
+    """
+    return check_safes_in_outputdir(
+        outputdir, safenames, verify_crc=True, max_workers=max_workers
+    )
+
+
+def check_safe_in_outputdir(outputdir, safename, verify_crc=False):
+    """
+    Check if the SAFE product exists in the output directory and verify its integrity if it is a zip file.
+
+    Parameters
+    ----------
+    outputdir (str)
+    safename (str) basename
+    verify_crc (bool): True -> decompress every member of the zip to verify its CRC (slow), False -> only look for the end of central directory record
+
+    Returns
+    -------
+        present_in_outputdir (bool): True -> the product is already in the output dir and valid
+    """
+    present_in_outdir = check_safes_in_outputdir(
+        outputdir, [safename], verify_crc=verify_crc
+    )[safename]
     logging.debug("present_in_outdir for %s : %s", safename, present_in_outdir)
     return present_in_outdir
 
 
+def check_safes_in_spool(safenames, conf):
+    """
+    Check which products are in the spool directory, the directory being listed once.
+
+    Parameters
+    ----------
+    safenames (iterable of str) basenames
+    conf (dict) configuration dictionary of cdsodatacli package
+
+    Returns
+    -------
+        present_in_spool (dict): safename -> True if the product is already in the spool dir
+    """
+    names = _listdir_cached(conf["spool"]).keys()
+    return {
+        safename: not names.isdisjoint(_safe_candidates(safename))
+        for safename in safenames
+    }
+
+
 def check_safe_in_spool(safename, conf):
     """
 
@@ -114,25 +479,74 @@ def check_safe_in_spool(safename, conf):
         present_in_spool (bool): True -> the product is already in the spool dir
 
     """
-    present_in_spool = False
-    for uu in ["", ".zip", "replaced"]:
-        if uu == "":
-            spool_potential_file = os.path.join(conf["spool"], safename)
-        elif uu == ".zip":
-            spool_potential_file = os.path.join(conf["spool"], safename + ".zip")
-        elif uu == "replaced":
-            spool_potential_file = os.path.join(
-                conf["spool"], safename.replace(".SAFE", ".zip")
-            )
-        else:
-            raise NotImplementedError
-        if os.path.exists(spool_potential_file):
-            present_in_spool = True
-            break
+    present_in_spool = check_safes_in_spool([safename], conf)[safename]
     logging.debug("present_in_spool : %s", present_in_spool)
     return present_in_spool
 
 
+def _parse_s1(safe, splitos):
+    # S1A_IW_GRDH_1SDV_20230101T000000_...
+    return safe[17:32], safe[12:13], safe[6:14]
+
+
+def _parse_s2(safe, splitos):
+    # S2A_MSIL1C_20230101T000000_...
+    return safe[11:26], safe[12:13], None
+
+
+def _parse_s3(safe, splitos):
+    # 简单的 S3 支持，基于 S3 命名规范
+    # S3A_SR_2_WAT____20170124T120058...
+    if len(splitos) > 7:
+        firstdate = splitos[7]
+    else:
+        # fallback or error handling
+        firstdate = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    if len(splitos) > 2:
+        level = splitos[2]  # e.g. '2' from S3A_SR_2...
+    else:
+        level = "0"
+    return firstdate, level, None
+
+
+def _parse_unknown(safe, splitos):
+    # Fallback for unknown formats
+    firstdate = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    return firstdate, safe[12:13], None
+
+
+# satellite prefix -> parser returning (first date, level, S1 sub name or None)
+_SAT_PARSERS = {"S1": _parse_s1, "S2": _parse_s2, "S3": _parse_s3}
+
+
+# number of days in the year before the first day of each month (non leap year)
+_CUM_DAYS = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+
+
+def _doy(y, m, d):
+    leap = m > 2 and ((y % 4 == 0 and y % 100 != 0) or y % 400 == 0)
+    return _CUM_DAYS[m - 1] + d + leap
+
+
+@functools.lru_cache(maxsize=4096)
+def _year_doy(firstdate):
+    # the date format is fixed (%Y%m%dT%H%M%S): plain slicing is much faster than strptime/strftime
+    try:
+        if len(firstdate) != 15 or firstdate[8] != "T":
+            raise ValueError(firstdate)
+        y = int(firstdate[0:4])
+        mo = int(firstdate[4:6])
+        da = int(firstdate[6:8])
+        if not 1 <= mo <= 12 or not 1 <= da <= 31:
+            raise ValueError(firstdate)
+        year = firstdate[0:4]
+        doy = "%03d" % _doy(y, mo, da)
+    except ValueError:
+        year = "0000"
+        doy = "000"
+    return year, doy
+
+
 def WhichArchiveDir(safe, conf):
     """
     Determine the archive directory path for a given safe based on its naming convention.
@@ -144,67 +558,85 @@ def WhichArchiveDir(safe, conf):
     Returns:
         gooddir (str): full path of the archive directory where the safe should be stored
     """
-    logging.debug("safe: %s", safe)
-    if "S1" in safe:
-        firstdate = safe[17:32]
-    elif "S2" in safe:
-        firstdate = safe[11:26]
-    elif "S3" in safe: 
-        # 简单的 S3 支持，基于 S3 命名规范
-        # S3A_SR_2_WAT____20170124T120058...
-        splitos = safe.split("_")
-        if len(splitos) > 7:
-            firstdate = splitos[7]
-        else:
-            # fallback or error handling
-            firstdate = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
-    else:
-        # Fallback for unknown formats
-        firstdate = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    return _which_archive_dir_cached(safe, conf["archive"])
 
-    try:
-        dt = datetime.datetime.strptime(firstdate, "%Y%m%dT%H%M%S")
-        year = dt.strftime("%Y")
-        doy = dt.strftime("%j")
-    except ValueError:
-        year = "0000"
-        doy = "000"
 
-    sat = safe.split("_")[0]
+@functools.lru_cache(maxsize=65536)
+def _which_archive_dir_cached(safe, archive_root):
+    # the archive directory only depends on the product name and the archive root
+    logging.debug("safe: %s", safe)
+    splitos = safe.split("_", 8)
+    # the satellite is given by the 2 first characters, no substring search needed
+    firstdate, level, subname = _SAT_PARSERS.get(safe[:2], _parse_unknown)(
+        safe, splitos
+    )
+    year, doy = _year_doy(firstdate)
+
+    sat = splitos[0]
     satdir = "sentinel-" + sat[2:].lower()
-    
+
     # 尝试解析 mode/acqui
-    try:
-        acqui = safe.split("_")[1]
+    if len(splitos) > 1:
+        acqui = splitos[1]
         if acqui and acqui[0] == "S":
             acqui = "SM"
-    except IndexError:
+    else:
         acqui = "UNKNOWN"
 
-    # 尝试解析 level
-    try:
-        if "S3" in safe:
-             level = safe.split("_")[2] # e.g. '2' from S3A_SR_2...
-        else:
-            level = safe[12:13]
-    except IndexError:
-        level = "0"
-        
     subproddir = "L" + level
-    
+
     # 尝试解析 subname
-    if "S1" in safe:
-        subname = safe[6:14]
+    if subname is not None:
         litlerep = sat + "_" + acqui + subname
     else:
-        litlerep = safe # S3 等其他卫星可能直接用 safe 名或者简化逻辑
+        litlerep = safe  # S3 等其他卫星可能直接用 safe 名或者简化逻辑
 
-    gooddir = os.path.join(
-        conf["archive"], satdir, subproddir, acqui, litlerep, year, doy
-    )
+    gooddir = os.path.join(archive_root, satdir, subproddir, acqui, litlerep, year, doy)
     return gooddir
 
 
+def check_safes_in_archive(safenames, conf):
+    """
+    Check which products are already in the archive, grouping them per archive sub-directory.
+
+    Parameters
+    ----------
+    safenames (iterable of str) basenames
+    conf (dict) configuration dictionary of cdsodatacli package
+
+    Returns
+    -------
+        present_in_archive (dict): safename -> True if the product is already in the archive dir
+    """
+    present_in_archive = {}
+    safes_per_archive_dir = defaultdict(list)
+    for safename in safenames:
+        present_in_archive[safename] = False
+        try:
+            archive_dir = WhichArchiveDir(safename, conf=conf)
+        except Exception as e:
+            logging.debug("Could not determine archive dir for %s: %s", safename, e)
+            continue
+        safes_per_archive_dir[archive_dir].append(safename)
+
+    for archive_dir, safes in safes_per_archive_dir.items():
+        if len(safes) == 1:
+            # archive directories hold many products: for a single product
+            # probing the few candidates is cheaper than listing the directory
+            archive_prefix = dir_prefix(archive_dir)
+            present_in_archive[safes[0]] = any(
+                _exists(archive_prefix + candidate)
+                for candidate in _safe_candidates(safes[0])
+            )
+        else:
+            names = get_names_in_dir(archive_dir)
+            for safename in safes:
+                present_in_archive[safename] = not names.isdisjoint(
+                    _safe_candidates(safename)
+                )
+    return present_in_archive
+
+
 def check_safe_in_archive(safename, conf):
     """
 
@@ -220,29 +652,8 @@ def check_safe_in_archive(safename, conf):
         present_in_archive (bool): True -> the product is already in the archive dir. False -> not present.
 
     """
-    present_in_archive = False
-    try:
-        archive_dir = WhichArchiveDir(safename, conf=conf)
-    except Exception as e:
-        logging.debug(f"Could not determine archive dir for {safename}: {e}")
-        return False
-
-    for uu in ["", ".zip", "replaced"]:
-        arch_potential_file0 = os.path.join(archive_dir, safename)
-        if uu == "":
-            arch_potential_file = arch_potential_file0
-        elif uu == ".zip":
-            arch_potential_file = arch_potential_file0 + ".zip"
-        elif uu == "replaced":
-            arch_potential_file = arch_potential_file0.replace(".SAFE", ".zip")
-        else:
-            raise NotImplementedError
-        if os.path.exists(arch_potential_file):
-            present_in_archive = True
-            break
+    present_in_archive = check_safes_in_archive([safename], conf)[safename]
     logging.debug("present_in_archive : %s", present_in_archive)
-    if present_in_archive:
-        logging.debug("the product is stored in : %s", arch_potential_file)
     return present_in_archive
 
 
@@ -259,20 +670,44 @@ def convert_json_opensearch_query_to_listing_safe_4_dowload(json_path) -> str:
     """
     logging.info("input json file: %s", json_path)
     output_txt = json_path.replace(".json", ".txt")
-    with open(json_path, "r") as f:
-        data = json.load(f)
-    if len(data["features"]) > 0:
-        df = pd.json_normalize(data["features"])
-        # Fix: ensure columns exist before selecting
-        if "properties.title" in df.columns and "id" in df.columns:
-            sub = df[["id", "properties.title"]]
-            sub.drop_duplicates()
-            sub.to_csv(output_txt, header=False, index=False)
+    with open(json_path, "rb") as f:
+        if ijson is not None and os.fstat(f.fileno()).st_size > JSON_STREAMING_MIN_SIZE:
+            # features are parsed one by one, the document is never fully in memory
+            nb_malformed = _write_id_title_listing(
+                ijson.items(f, "features.item"), output_txt
+            )
         else:
-            logging.warning("JSON structure unexpected, missing 'id' or 'properties.title'")
-    else:
-        # Create empty file
-        open(output_txt, "w").close()
-            
+            data = json_loads(f.read())
+            nb_malformed = _write_id_title_listing(data.get("features", ()), output_txt)
+    if nb_malformed > 0:
+        logging.warning(
+            "JSON structure unexpected, %s features without 'id' or 'properties.title'",
+            nb_malformed,
+        )
+
     logging.info("output_txt : %s", output_txt)
     return output_txt
+
+
+def _write_id_title_listing(features, output_txt):
+    """
+    Write the (id, properties.title) of OpenSearch features as a csv listing, without duplicates.
+
+    Returns
+    -------
+        nb_malformed (int): number of features skipped because a field is missing
+    """
+    seen = set()
+    nb_malformed = 0
+    with open(output_txt, "w", newline="") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        for feature in features:
+            try:
+                row = (feature["id"], feature["properties"]["title"])
+            except (KeyError, TypeError):
+                nb_malformed += 1
+                continue
+            if row not in seen:
+                seen.add(row)
+                writer.writerow(row)
+    return nb_malformed
@@ -3,11 +3,13 @@ import os.path
 from yaml import CLoader as Loader
 from yaml import load
 import logging
-from cdsodatacli.utils import local_config_pontential_path, config_path
+from cdsodatacli.utils import _local_config_path, _pkg_config_path
 
 
 def test_to_make_sure_localconfig_and_config_contains_same_keys():
     all_keys_are_presents = True
+    local_config_pontential_path = _local_config_path()
+    config_path = _pkg_config_path()
     if os.path.exists(local_config_pontential_path) and os.path.exists(config_path):
         stream = open(local_config_pontential_path, "r")
         conflocal = load(stream, Loader=Loader)
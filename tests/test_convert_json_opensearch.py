@@ -0,0 +1,62 @@
+import json
+
+import pandas as pd
+import pytest
+from cdsodatacli import utils
+from cdsodatacli.utils import convert_json_opensearch_query_to_listing_safe_4_dowload
+
+features = [
+    {
+        "id": "aa877202-1479-4f06-b2d6-620ee959dc47",
+        "properties": {
+            "title": "S1A_WV_SLC__1SSV_20231110T201811_20231110T203308_051159_062BA3_954C.SAFE",
+            "cloudCover": 0.0,
+        },
+    },
+    # duplicated feature, written once
+    {
+        "id": "aa877202-1479-4f06-b2d6-620ee959dc47",
+        "properties": {
+            "title": "S1A_WV_SLC__1SSV_20231110T201811_20231110T203308_051159_062BA3_954C.SAFE"
+        },
+    },
+    {
+        "id": "a7d833c4-6b92-4bf8-9f79-0b39add53e16",
+        "properties": {
+            "title": "S1A_WV_SLC__1SSV_20231110T234523_20231110T235358_051161_062BB4_B4D0.SAFE"
+        },
+    },
+    # feature without title, skipped
+    {"id": "f0000000-0000-0000-0000-000000000000", "properties": {}},
+]
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_convert_json_opensearch_query_to_listing(tmp_path, monkeypatch, streaming):
+    if streaming:
+        if utils.ijson is None:
+            pytest.skip("ijson is not installed")
+        monkeypatch.setattr(utils, "JSON_STREAMING_MIN_SIZE", 0)
+    json_path = tmp_path / "query.json"
+    json_path.write_text(
+        json.dumps({"type": "FeatureCollection", "features": features})
+    )
+
+    output_txt = convert_json_opensearch_query_to_listing_safe_4_dowload(str(json_path))
+
+    df = pd.read_csv(output_txt, names=["id", "safename"])
+    assert df["id"].tolist() == [
+        "aa877202-1479-4f06-b2d6-620ee959dc47",
+        "a7d833c4-6b92-4bf8-9f79-0b39add53e16",
+    ]
+    assert df["safename"].str.endswith(".SAFE").all()
+
+
+def test_convert_json_opensearch_query_without_features(tmp_path):
+    json_path = tmp_path / "query.json"
+    json_path.write_text(json.dumps({"type": "FeatureCollection", "features": []}))
+
+    output_txt = convert_json_opensearch_query_to_listing_safe_4_dowload(str(json_path))
+
+    with open(output_txt) as f:
+        assert f.read() == ""
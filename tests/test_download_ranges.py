@@ -0,0 +1,159 @@
+import datetime
+import errno
+import http.server
+import os
+import re
+import threading
+
+import pandas as pd
+import pytest
+import requests
+from urllib3.exceptions import ProtocolError
+
+from cdsodatacli import download
+from cdsodatacli.download import (
+    CDS_Odata_download_one_product_v2,
+    download_ranges,
+    fast_move,
+)
+from cdsodatacli.session import (
+    extra_session_safename,
+    get_sessions_download_available,
+    remove_semaphore_session_file,
+)
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class ProductHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # "range": 206 replies, "ignore_range": 200 replies, "short_range": 206 replies missing bytes
+    mode = "range"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, with_body):
+        requested = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if requested and self.mode != "ignore_range":
+            start, end = map(int, requested.groups())
+            if self.mode == "short_range":
+                end -= 10
+            body = DATA[start : end + 1]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %s-%s/%s" % (start, end, len(DATA))
+            )
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(with_body=True)
+
+    def do_HEAD(self):
+        self._reply(with_body=False)
+
+
+@pytest.fixture
+def product_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ProductHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%s/product" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    ProductHandler.mode = "range"
+
+
+def _download_ranges_to(path, url):
+    with requests.Session() as session, open(path, "wb") as f:
+        os.ftruncate(f.fileno(), len(DATA))
+        return download_ranges(session, {}, url, f.fileno(), len(DATA), 4)
+
+
+def test_download_ranges_reassembles_product(tmp_path, product_url):
+    output = tmp_path / "product.zip"
+    assert _download_ranges_to(output, product_url) is True
+    assert output.read_bytes() == DATA
+
+
+def test_download_ranges_server_ignoring_range(tmp_path, product_url):
+    ProductHandler.mode = "ignore_range"
+    assert _download_ranges_to(tmp_path / "product.zip", product_url) is False
+
+
+def test_download_ranges_incomplete_range(tmp_path, product_url):
+    ProductHandler.mode = "short_range"
+    with pytest.raises(ProtocolError):
+        _download_ranges_to(tmp_path / "product.zip", product_url)
+
+
+@pytest.mark.parametrize(
+    ("mode", "nb_connections"),
+    [("range", 4), ("ignore_range", 4), ("range", 1)],
+)
+def test_download_one_product(tmp_path, monkeypatch, product_url, mode, nb_connections):
+    ProductHandler.mode = mode
+    monkeypatch.setattr(download, "RANGE_DOWNLOAD_MIN_SIZE", 1024)
+    output = tmp_path / "S1A_WV_SLC__1SSV_20231110T201811.SAFE.zip"
+    with requests.Session() as session:
+        _, status_meaning, safename_base, _ = CDS_Odata_download_one_product_v2(
+            session,
+            {},
+            product_url,
+            str(output),
+            "CDSE_access_token_login_20231110t201811.txt",
+            nb_connections=nb_connections,
+        )
+    assert status_meaning == "OK"
+    assert safename_base == "S1A_WV_SLC__1SSV_20231110T201811.SAFE"
+    assert output.read_bytes() == DATA
+    assert os.listdir(tmp_path) == [output.name]
+
+
+@pytest.mark.parametrize(("nb_products", "expected"), [(1, [4]), (2, [2, 2])])
+def test_spare_session_slots_given_to_products(tmp_path, nb_products, expected):
+    login = "user@example.com"
+    conf = {
+        "logins": {login: "password"},
+        "token_directory": str(tmp_path),
+        "active_session_directory": str(tmp_path),
+    }
+    date_token = datetime.datetime.today().strftime("%Y%m%dt%H%M%S")
+    (tmp_path / ("CDSE_access_token_%s_%s.txt" % (login, date_token))).write_text(
+        "token"
+    )
+    safes = ["S1A_WV_SLC__1SSV_2023111%sT201811.SAFE" % ii for ii in range(nb_products)]
+    subset = pd.DataFrame(
+        {"safe": safes, "urls": ["url"] * nb_products, "outputpath": safes}
+    )
+    df = get_sessions_download_available(conf, subset, max_connections_per_product=4)
+    assert list(df["nb_connections"]) == expected
+    session_files = list(tmp_path.glob("CDSE_active_session_*.txt"))
+    assert len(session_files) == sum(expected)
+
+    remove_semaphore_session_file(
+        str(tmp_path), safename=extra_session_safename(safes[0], "*"), login=login
+    )
+    remove_semaphore_session_file(str(tmp_path), safename=safes[0], login=login)
+    session_files = list(tmp_path.glob("CDSE_active_session_*.txt"))
+    assert len(session_files) == sum(expected[1:])
+
+
+def test_fast_move_across_filesystems(tmp_path, monkeypatch):
+    def replace_across_devices(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    src = tmp_path / "product.zip.tmp"
+    dst = tmp_path / "product.zip"
+    src.write_bytes(DATA)
+    monkeypatch.setattr(os, "replace", replace_across_devices)
+    fast_move(str(src), str(dst))
+    assert dst.read_bytes() == DATA
+    assert not src.exists()
@@ -0,0 +1,103 @@
+import zipfile
+from collections import defaultdict
+
+import pandas as pd
+import pytest
+
+from cdsodatacli import utils
+from cdsodatacli.download import filter_product_already_present
+from cdsodatacli.utils import (
+    WhichArchiveDir,
+    check_safes_in_archive,
+    check_safes_in_outputdir,
+)
+
+safes = [
+    "S1A_IW_GRDH_1SDV_20230101T000000_20230101T000025_046574_059546_%s.SAFE" % suffix
+    for suffix in ("AAAA", "BBBB", "CCCC", "DDDD")
+]
+
+
+def _write_zip(path):
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("manifest.safe", "content")
+
+
+@pytest.fixture
+def conf(tmp_path):
+    (tmp_path / "spool").mkdir()
+    (tmp_path / "outputdir").mkdir()
+    return {
+        "archive": str(tmp_path / "archive"),
+        "spool": str(tmp_path / "spool"),
+        "URL_download": "https://download/odata/v1/Products(%s)/$value",
+    }
+
+
+@pytest.mark.parametrize("as_path", [False, True])
+def test_filter_product_already_present(tmp_path, conf, as_path):
+    outputdir = tmp_path / "outputdir"
+    archive_dir = tmp_path / WhichArchiveDir(safes[0], conf)
+    archive_dir.mkdir(parents=True)
+    # archive > spool > output dir
+    _write_zip(archive_dir / (safes[0] + ".zip"))
+    for safe in safes[:2]:
+        (tmp_path / "spool" / safe).mkdir()
+    for safe in safes[:3]:
+        _write_zip(outputdir / (safe + ".zip"))
+    df = pd.DataFrame({"id": ["a", "b", "c", "d"], "safe": safes})
+
+    df_todownload, cpt = filter_product_already_present(
+        defaultdict(int), df, outputdir if as_path else str(outputdir), conf
+    )
+
+    assert dict(cpt) == {
+        "archived_product": 1,
+        "in_spool_product": 1,
+        "in_outdir_product": 1,
+        "product_absent_from_local_disks": 1,
+    }
+    assert df_todownload["safe"].tolist() == [safes[3]]
+    assert df_todownload["urls"].tolist() == [conf["URL_download"] % "d"]
+    assert df_todownload["outputpath"].tolist() == [
+        str(outputdir / (safes[3] + ".zip"))
+    ]
+
+
+def test_check_safes_in_outputdir(tmp_path, monkeypatch):
+    outputdir = tmp_path / "outputdir"
+    outputdir.mkdir()
+    # <name>.zip candidate of a .SAFE product
+    _write_zip(outputdir / safes[0].replace(".SAFE", ".zip"))
+    # unpacked product: no zip probe
+    (outputdir / safes[1]).mkdir()
+    # truncated download: removed
+    _write_zip(outputdir / (safes[2] + ".zip"))
+    with open(outputdir / (safes[2] + ".zip"), "r+b") as f:
+        f.truncate(20)
+    probed = []
+    zip_tail_ok = utils._zip_tail_ok
+    monkeypatch.setattr(
+        utils, "_zip_tail_ok", lambda path: probed.append(path) or zip_tail_ok(path)
+    )
+
+    present = check_safes_in_outputdir(str(outputdir), safes)
+
+    assert present == dict(zip(safes, [True, True, False, False]))
+    assert not any(safes[1] in path for path in probed)
+    assert sorted(p.name for p in outputdir.iterdir()) == sorted(
+        [safes[0].replace(".SAFE", ".zip"), safes[1]]
+    )
+
+
+def test_check_safes_in_archive(tmp_path, conf):
+    archive_dir = tmp_path / WhichArchiveDir(safes[0], conf)
+    archive_dir.mkdir(parents=True)
+    (archive_dir / safes[0]).mkdir()
+    _write_zip(archive_dir / (safes[1] + ".zip"))
+
+    # several products per archive directory (listing) or a single one (probes)
+    assert check_safes_in_archive(safes, conf) == dict(
+        zip(safes, [True, True, False, False])
+    )
+    assert check_safes_in_archive(safes[1:2], conf) == {safes[1]: True}
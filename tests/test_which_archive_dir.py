@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from cdsodatacli.utils import WhichArchiveDir
+
+
+@pytest.mark.parametrize(
+    ("safe", "expected_subdir"),
+    [
+        (
+            "S1A_IW_GRDH_1SDV_20230101T000000_20230101T000025_046574_059546_AAAA.SAFE",
+            "sentinel-a/L1/IW/S1A_IW_GRDH_1S/2023/001",
+        ),
+        (
+            "S1B_WV_OCN__2SSV_20210315T120000_20210315T120500_026000_031A00_CCCC.SAFE",
+            "sentinel-b/L2/WV/S1B_WV_OCN__2S/2021/074",
+        ),
+        # stripmap: S3 beam of S1, not a Sentinel-3 product
+        (
+            "S1A_S3_SLC__1SDV_20230102T101010_20230102T101030_046574_059546_BBBB.SAFE",
+            "sentinel-a/L1/SM/S1A_SM_SLC__1S/2023/002",
+        ),
+        (
+            "S2A_MSIL1C_20230101T103421_N0509_R108_T32TQM_20230101T123456.SAFE",
+            "sentinel-a/L0/MSIL1C/"
+            "S2A_MSIL1C_20230101T103421_N0509_R108_T32TQM_20230101T123456.SAFE/2023/001",
+        ),
+        # "PS2" in the name must not make it a Sentinel-2 product
+        (
+            "S3B_OL_1_EFR____20230101T000000_20230101T000300_20230102T120000"
+            "_0179_074_123_2160_PS2_O_NT_002.SEN3",
+            "sentinel-b/L1/OL/S3B_OL_1_EFR____20230101T000000_20230101T000300"
+            "_20230102T120000_0179_074_123_2160_PS2_O_NT_002.SEN3/2023/001",
+        ),
+        (
+            "S3A_SR_2_WAT____20240229T235959_20240301T000959_20240326T000000"
+            "_3059_109_273______MAR_O_NT_005.SEN3",
+            "sentinel-a/L2/SM/S3A_SR_2_WAT____20240229T235959_20240301T000959"
+            "_20240326T000000_3059_109_273______MAR_O_NT_005.SEN3/2024/060",
+        ),
+    ],
+)
+def test_which_archive_dir(safe, expected_subdir):
+    conf = {"archive": "/archive"}
+    assert WhichArchiveDir(safe, conf) == os.path.join(
+        "/archive", *expected_subdir.split("/")
+    )